@@ -1,18 +1,32 @@
 import asyncio
+import codecs
 import logging
-import io
-import csv
+import multiprocessing
 import os
-from typing import List, Optional
+import random
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from typing import BinaryIO, Iterable, Iterator, List, NamedTuple, Optional
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, BufferedInputFile
+from aiogram.types import Message, FSInputFile
 from aiogram.filters import Command
-from aiogram.exceptions import TelegramNetworkError, TelegramBadRequest
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramBadRequest, TelegramRetryAfter
 
 import organic_ya
 import xmltree
 
+# organic_ya работает через requests: его таймауты и сетевые ошибки не наследуются
+# от встроенных TimeoutError/ConnectionError
+try:
+    import requests
+    TRANSIENT_ERRORS = (TimeoutError, ConnectionError, requests.Timeout, requests.ConnectionError)
+except ImportError:
+    TRANSIENT_ERRORS = (TimeoutError, ConnectionError)
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -27,13 +41,123 @@ BOT_TOKEN = os.environ.get('TOKENBOT')
 if not BOT_TOKEN:
     raise RuntimeError("TOKENBOT не найден в .env файле!")
 
-bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
 # Константы
 MAX_QUERIES = 10000  # Ограничение на количество запросов
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
-SLEEP_BETWEEN_REQUESTS = 0.1  # Увеличена задержка для стабильности
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Размер блока при скачивании файла
+FILE_ENCODINGS = ['utf-8-sig', 'cp1251']  # Поддерживаемые кодировки файлов с запросами
+MAX_REQUESTS_PER_SECOND = float(os.environ.get('XMLRIVER_MAX_RATE', 10))  # Лимит запросов к xmlriver в секунду
+CONCURRENT_REQUESTS = int(os.environ.get('XMLRIVER_CONCURRENCY', 8))  # Количество одновременных запросов к xmlriver
+MAX_ACTIVE_PROCESSING = 3  # Количество списков запросов, обрабатываемых одновременно
+BATCH_SIZE = 500  # Количество запросов в одной порции обработки
+RETRY_ATTEMPTS = 4  # Количество попыток запроса к xmlriver при временных ошибках
+RETRY_MAX_DELAY = 10  # Максимальная задержка между попытками (секунды)
+PROGRESS_UPDATE_INTERVAL = 2  # Интервал обновления статуса (секунды)
+XML_CACHE_SIZE = 4096  # Количество ответов xmlriver в кэше
+XML_CACHE_TTL = 60 * 60  # Время жизни ответа в кэше (секунды)
+
+if MAX_REQUESTS_PER_SECOND <= 0:
+    raise RuntimeError("XMLRIVER_MAX_RATE должен быть больше 0!")
+
+class AsyncLimiter:
+    """Ограничение частоты запросов по алгоритму token bucket"""
+
+    def __init__(self, max_rate: float, time_period: float = 1.0):
+        if max_rate <= 0:
+            raise ValueError("max_rate должен быть больше 0")
+
+        self.max_rate = max_rate
+        self.time_period = time_period
+        # Емкость не меньше одного токена, иначе при max_rate < 1 запрос не пройдет никогда
+        self.capacity = max(1, max_rate)
+        self._tokens = self.capacity
+        self._last_check = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ожидание свободного токена (допускает всплески до capacity запросов)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.capacity,
+                    self._tokens + (now - self._last_check) * self.max_rate / self.time_period
+                )
+                self._last_check = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) * self.time_period / self.max_rate)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+class TTLCache:
+    """LRU кэш с ограничением времени жизни записей"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        """Получение значения или None, если записи нет или она устарела"""
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Сохранение значения с вытеснением самых старых записей"""
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+class ParsePool:
+    """Пул процессов для разбора ответов xmlriver, пересоздаваемый после падения процесса"""
+
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers
+        # Процессы запускаются позже потоков xmlriver, поэтому fork не используем
+        start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._mp_context = multiprocessing.get_context(start_method)
+        self._executor = self._create_executor()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=self._mp_context)
+
+    async def run(self, func, *args):
+        """Выполнение func в пуле; если пул сломан, он пересоздается и задача повторяется"""
+        loop = asyncio.get_running_loop()
+        executor = self._executor
+        try:
+            return await loop.run_in_executor(executor, func, *args)
+        except BrokenProcessPool:
+            # Пересоздаем пул один раз, даже если ошибку получили сразу несколько задач
+            if self._executor is executor:
+                logger.warning("Пул процессов разбора XML сломан, создаю новый")
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._create_executor()
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
 
 @dp.message(Command(commands=['start']))
 async def cmd_start(message: Message):
@@ -46,99 +170,322 @@ async def cmd_start(message: Message):
         "📊 Получите CSV файл с результатами!"
     )
 
-async def process_queries(queries: List[str], message: Message) -> Optional[bytes]:
+def _csv_escape(value) -> str:
+    """Экранирование значения для CSV (в кавычки берется только при необходимости)"""
+    text = '' if value is None else str(value)
+    if '"' in text or ',' in text or '\n' in text or '\r' in text:
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+def _csv_line(row) -> str:
+    """Формирование строки CSV"""
+    return ','.join(map(_csv_escape, row)) + '\r\n'
+
+def _is_transient_error(error: Exception) -> bool:
+    """Проверка, имеет ли смысл повторить запрос (таймаут, сетевой сбой, 429 или 5xx)"""
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(error, 'status', None) or getattr(error, 'code', None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+
+    # Повторяем только таймауты и сетевые сбои, остальные ошибки постоянные
+    return isinstance(error, TRANSIENT_ERRORS)
+
+class XmlRiverClient:
+    """Клиент xmlriver на все время работы бота: общие соединения, лимит частоты и кэш ответов"""
+
+    def __init__(self):
+        self.organic = organic_ya.Organic()
+        # Потоки для блокирующих запросов: общее число соединений не превышает CONCURRENT_REQUESTS
+        self.executor = ThreadPoolExecutor(max_workers=CONCURRENT_REQUESTS, thread_name_prefix='xmlriver')
+        # Общий лимит запросов для всех пользователей бота
+        self.limiter = AsyncLimiter(MAX_REQUESTS_PER_SECOND)
+        # Кэш ответов по нормализованному запросу
+        self.cache = TTLCache(XML_CACHE_SIZE, XML_CACHE_TTL)
+
+    async def search(self, query: str):
+        """Запрос к xmlriver с повторами и экспоненциальной задержкой при временных ошибках"""
+        loop = asyncio.get_running_loop()
+        for attempt in range(1, RETRY_ATTEMPTS + 1):
+            try:
+                async with self.limiter:
+                    # search_xmlriver блокирующий - выполняем его в отдельном потоке
+                    return await loop.run_in_executor(self.executor, self.organic.search_xmlriver, query)
+            except Exception as e:
+                if attempt == RETRY_ATTEMPTS or not _is_transient_error(e):
+                    raise
+
+                delay = min(RETRY_MAX_DELAY, 2 ** (attempt - 1)) + random.uniform(0, 1)
+                logger.warning(
+                    f"Временная ошибка при запросе '{query}' (попытка {attempt}/{RETRY_ATTEMPTS}): {e}. "
+                    f"Повтор через {delay:.1f} с"
+                )
+                await asyncio.sleep(delay)
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# Заголовок CSV: схема ответа xmlriver постоянна, поэтому получаем его один раз
+_csv_header = None
+
+def _get_header(xml_data) -> list:
+    """Заголовок CSV, разобранный из первого успешного ответа xmlriver"""
+    global _csv_header
+    if _csv_header is None:
+        _csv_header = xmltree.XmlTree.get_header(xml_data)
+    return _csv_header
+
+def _parse_row(xml_data, query: str) -> list:
+    """Разбор ответа xmlriver в строку CSV (выполняется в отдельном процессе)"""
+    return list(xmltree.XmlTree(xml_data, query).get_row())
+
+class ProcessingResult(NamedTuple):
+    """Результат обработки списка запросов"""
+    path: str  # Путь к временному CSV файлу
+    written: int  # Количество строк с результатами в файле
+    failed: int  # Количество запросов, завершившихся ошибкой
+    interrupted: bool  # Обработка прервана, файл содержит частичный результат
+
+async def process_queries(
+    queries: List[str], message: Message, xmlriver: XmlRiverClient, parse_pool: ParsePool
+) -> Optional[ProcessingResult]:
     """
     Обработка списка поисковых запросов
     
     Args:
         queries: Список поисковых запросов
         message: Сообщение для отправки обновлений статуса
+        xmlriver: Клиент xmlriver
+        parse_pool: Пул процессов для разбора ответов xmlriver
         
     Returns:
-        CSV данные в виде bytes или None при ошибке
+        Результат с путем к временному CSV файлу или None при ошибке
     """
-    if len(queries) > MAX_QUERIES:
-        await message.reply(f"❌ Слишком много запросов! Максимум {MAX_QUERIES}, получено {len(queries)}")
-        return None
-
+    tasks = []
+    written = 0
+    failed = 0
+    # Строки пишем сразу во временный файл, не накапливая результат в памяти
+    # (utf-8-sig добавляет BOM для корректного отображения в Excel)
+    output = tempfile.NamedTemporaryFile(
+        mode='w', encoding='utf-8-sig', newline='', suffix='.csv', delete=False
+    )
+    result_path = None
     try:
-        a = organic_ya.Organic()
-        output = io.StringIO()
-        writer = None
-        header_written = False
-        
+        queries = [query.strip() for query in queries if query.strip()]
         total_queries = len(queries)
+        semaphore = asyncio.Semaphore(CONCURRENT_REQUESTS)
+        rows_queue: asyncio.Queue = asyncio.Queue()
+
+        header = None
+        completed = 0
         processed = 0
 
-        for i, query in enumerate(queries, 1):
-            if not query.strip():
-                continue
-                
-            try:
-                logger.info(f"Обработка запроса {i}/{total_queries}: {query}")
-                
-                # Получаем XML данные
-                xml_data = a.search_xmlriver(query.strip())
-                
-                # Записываем заголовок только один раз
-                if not header_written:
-                    header = xmltree.XmlTree.get_header(xml_data)
-                    writer = csv.writer(output)
-                    writer.writerow(header)
-                    header_written = True
-
-                # Обрабатываем данные и записываем строку
-                b = xmltree.XmlTree(xml_data, query.strip())
-                row = b.get_row()
-                writer.writerow(row)
-                processed += 1
-                
-                # Обновляем статус каждые 10 запросов
-                if i % 10 == 0:
-                    try:
-                        await message.edit_text(f"⏳ Обработано {i}/{total_queries} запросов...")
-                    except TelegramBadRequest:
-                        # Игнорируем ошибку, если сообщение не изменилось
-                        pass
-                
-                # Задержка между запросами
-                await asyncio.sleep(SLEEP_BETWEEN_REQUESTS)
-                
-            except Exception as e:
-                logger.error(f"Ошибка при обработке запроса '{query}': {e}")
-                # Продолжаем обработку других запросов
-                continue
+        async def worker(index: int, query: str):
+            """Обработка одного запроса (не более CONCURRENT_REQUESTS одновременно)"""
+            nonlocal header, completed, processed, failed
+            row = None
+
+            async with semaphore:
+                try:
+                    logger.info(f"Обработка запроса {index + 1}/{total_queries}: {query}")
+                    key = query.lower()
+                    xml_data = xmlriver.cache.get(key)
+                    cached = xml_data is not None
+                    if not cached:
+                        xml_data = await xmlriver.search(query)
+
+                    # Обрабатываем данные и получаем строку
+                    parsed = await parse_pool.run(_parse_row, xml_data, query)
+
+                    # Заголовок берем из первого успешно разобранного ответа
+                    if header is None:
+                        header = _get_header(xml_data)
+
+                    row = parsed
+                    processed += 1
+
+                    # Кэшируем только успешно разобранные ответы (ошибки xmlriver приходят в теле ответа)
+                    if not cached:
+                        xmlriver.cache.put(key, xml_data)
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке запроса '{query}': {e}")
+                    failed += 1
+
+            await rows_queue.put((index, row))
+            completed += 1
+
+        async def progress_reporter():
+            """Обновление статуса не чаще раза в PROGRESS_UPDATE_INTERVAL секунд"""
+            last_completed = 0
+            while True:
+                await asyncio.sleep(PROGRESS_UPDATE_INTERVAL)
+                if completed == last_completed:
+                    continue
+
+                current = completed
+                status = f"⏳ Обработано {current}/{total_queries} запросов..."
+                if failed:
+                    status += f"\n⚠️ Ошибок: {failed}"
+                try:
+                    await message.edit_text(status)
+                    last_completed = current
+                except TelegramBadRequest:
+                    # Игнорируем ошибку, если сообщение не изменилось
+                    last_completed = current
+                except TelegramRetryAfter as e:
+                    # Telegram просит подождать перед следующим редактированием
+                    await asyncio.sleep(e.retry_after)
+                except TelegramAPIError as e:
+                    # Сбой обновления статуса не должен останавливать отчет о прогрессе
+                    logger.warning(f"Не удалось обновить статус: {e}")
+
+        async def csv_writer():
+            """Запись готовых строк в CSV в исходном порядке запросов"""
+            nonlocal written
+            pending = {}
+            next_index = 0
+            header_written = False
+
+            finished = False
+            while not finished:
+                # Забираем из очереди все уже готовые строки, чтобы записать их одним вызовом
+                items = [await rows_queue.get()]
+                while not rows_queue.empty():
+                    items.append(rows_queue.get_nowait())
+
+                for item in items:
+                    rows_queue.task_done()
+                    if item is None:
+                        finished = True
+                        continue
+
+                    index, row = item
+                    pending[index] = row
+
+                # Записываем все строки, для которых готовы предыдущие
+                ready = []
+                while next_index in pending:
+                    row = pending.pop(next_index)
+                    next_index += 1
+                    if row is not None:
+                        ready.append(row)
+
+                if ready:
+                    rows_count = len(ready)
+                    if not header_written:
+                        ready.insert(0, header)
+                        header_written = True
+                    output.writelines(map(_csv_line, ready))
+                    written += rows_count
+
+        writer_task = asyncio.create_task(csv_writer())
+        tasks = [writer_task, asyncio.create_task(progress_reporter())]
+
+        # Запросы обрабатываем порциями: следующая порция начинается,
+        # когда все строки текущей записаны в файл
+        for start in range(0, total_queries, BATCH_SIZE):
+            workers = [
+                asyncio.create_task(worker(i, queries[i]))
+                for i in range(start, min(start + BATCH_SIZE, total_queries))
+            ]
+            tasks.extend(workers)
+            await asyncio.gather(*workers)
+
+            # Ждем, пока writer разберет очередь (или завершится с ошибкой)
+            drained = asyncio.create_task(rows_queue.join())
+            tasks.append(drained)
+            await asyncio.wait({drained, writer_task}, return_when=asyncio.FIRST_COMPLETED)
+            if writer_task.done():
+                writer_task.result()
+
+        await rows_queue.put(None)
+        await writer_task
 
         if processed == 0:
             await message.reply("❌ Не удалось обработать ни одного запроса")
             return None
 
-        # Конвертируем в bytes
-        csv_content = output.getvalue()
-        output.close()
-        
-        if not csv_content:
-            return None
-            
-        return csv_content.encode('utf-8-sig')  # BOM для корректного отображения в Excel
+        result_path = output.name
+        return ProcessingResult(result_path, written, failed, interrupted=False)
         
     except Exception as e:
         logger.error(f"Общая ошибка при обработке запросов: {e}")
         await message.reply(f"❌ Произошла ошибка при обработке: {str(e)}")
+
+        # Отдаем уже записанные строки, чтобы не терять результат целиком
+        if written:
+            result_path = output.name
+            return ProcessingResult(result_path, written, failed, interrupted=True)
         return None
+    finally:
+        # Отменяем незавершенные задачи при досрочном выходе
+        for task in tasks:
+            task.cancel()
+
+        output.close()
+        if result_path is None:
+            os.remove(output.name)
+
+def _iter_queries(lines: Iterable[str]) -> Iterator[str]:
+    """Отбор непустых строк с запросами"""
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):  # Игнорируем комментарии
+            yield line
 
-async def extract_queries_from_text(text: str) -> List[str]:
+def _unique_queries(queries: Iterable[str]) -> List[str]:
+    """Удаление повторяющихся запросов (без учета регистра) с сохранением порядка"""
+    unique = {}
+    for query in queries:
+        unique.setdefault(query.lower(), query)
+    return list(unique.values())
+
+def _decode_chunks(file: BinaryIO, encoding: str, errors: str = 'strict') -> Iterator[str]:
+    """Чтение и декодирование файла блоками по DOWNLOAD_CHUNK_SIZE байт"""
+    decoder = codecs.getincrementaldecoder(encoding)(errors=errors)
+    for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b''):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+def _iter_lines(chunks: Iterable[str]) -> Iterator[str]:
+    """Разбиение текста, поступающего частями, на строки с теми же границами, что у str.splitlines"""
+    parts = []  # Части незавершенной строки, склеиваются один раз при ее завершении
+    for chunk in chunks:
+        if not chunk:
+            continue
+
+        # '\r' в конце предыдущего блока может оказаться началом '\r\n'
+        if parts and parts[-1].endswith('\r'):
+            if chunk.startswith('\n'):
+                parts.append('\n')
+                chunk = chunk[1:]
+            yield ''.join(parts)
+            parts = []
+            if not chunk:
+                continue
+
+        lines = chunk.splitlines(keepends=True)
+        last = lines.pop()
+        if lines:
+            lines[0] = ''.join(parts) + lines[0]
+            parts = []
+            yield from lines
+
+        # Последняя строка блока может быть неполной или оканчиваться '\r' - откладываем ее
+        parts.append(last)
+        if not last.endswith('\r') and last.splitlines()[0] != last:
+            yield ''.join(parts)
+            parts = []
+
+    if parts:
+        yield ''.join(parts)
+
+def extract_queries_from_text(text: str) -> List[str]:
     """Извлечение запросов из текста"""
     if not text:
         return []
     
-    queries = []
-    for line in text.strip().splitlines():
-        line = line.strip()
-        if line and not line.startswith('#'):  # Игнорируем комментарии
-            queries.append(line)
-    
-    return queries
+    return _unique_queries(_iter_queries(text.splitlines()))
 
 async def extract_queries_from_file(message: Message) -> Optional[List[str]]:
     """Извлечение запросов из файла"""
@@ -156,29 +503,24 @@ async def extract_queries_from_file(message: Message) -> Optional[List[str]]:
         return None
     
     try:
-        # Скачиваем файл
-        file_info = await bot.get_file(message.document.file_id)
-        buffer = io.BytesIO()
-        await bot.download_file(file_info.file_path, buffer)
-        buffer.seek(0)
-
-        # Пробуем разные кодировки
-        encodings = ['utf-8', 'utf-8-sig', 'windows-1251', 'cp1251']
-        content = None
-        
-        for encoding in encodings:
-            try:
-                buffer.seek(0)
-                content = buffer.read().decode(encoding)
-                break
-            except UnicodeDecodeError:
-                continue
-        
-        if content is None:
-            await message.reply("❌ Не удалось прочитать файл. Проверьте кодировку.")
-            return None
+        # Скачиваем файл во временный файл на диске (download_file учитывает и локальный Bot API)
+        file_info = await message.bot.get_file(message.document.file_id)
+        with tempfile.TemporaryFile() as buffer:
+            await message.bot.download_file(file_info.file_path, buffer, chunk_size=DOWNLOAD_CHUNK_SIZE)
 
-        return await extract_queries_from_text(content)
+            # Декодируем строго: utf-8-sig читает utf-8 как с BOM, так и без него,
+            # при ошибке перечитываем файл в cp1251
+            for encoding in FILE_ENCODINGS:
+                try:
+                    buffer.seek(0)
+                    # Читаем файл по частям, не загружая его целиком в память
+                    queries = _iter_queries(_iter_lines(_decode_chunks(buffer, encoding)))
+                    return _unique_queries(queries)
+                except UnicodeDecodeError:
+                    continue
+
+        await message.reply("❌ Не удалось прочитать файл. Проверьте кодировку.")
+        return None
         
     except Exception as e:
         logger.error(f"Ошибка при чтении файла: {e}")
@@ -186,14 +528,19 @@ async def extract_queries_from_file(message: Message) -> Optional[List[str]]:
         return None
 
 @dp.message(F.content_type.in_({'text', 'document'}))
-async def handle_message(message: Message):
+async def handle_message(
+    message: Message,
+    xmlriver: XmlRiverClient,
+    parse_pool: ParsePool,
+    processing_gate: asyncio.Semaphore,
+):
     """Основной обработчик сообщений"""
     try:
         queries = []
 
         # Обработка текстового сообщения
         if message.text and not message.text.startswith('/'):
-            queries = await extract_queries_from_text(message.text)
+            queries = extract_queries_from_text(message.text)
             
         # Обработка файла
         elif message.document:
@@ -211,30 +558,49 @@ async def handle_message(message: Message):
             )
             return
 
+        # Проверяем лимит до очереди на обработку, чтобы не держать заведомо отклоненный список
+        if len(queries) > MAX_QUERIES:
+            await message.reply(f"❌ Слишком много запросов! Максимум {MAX_QUERIES}, получено {len(queries)}")
+            return
+
         # Информируем пользователя
-        status_message = await message.answer(
+        status_text = (
             f"⏳ Начинаю обработку {len(queries)} запросов...\n"
-            f"Это может занять {len(queries) * SLEEP_BETWEEN_REQUESTS / 60:.1f} минут"
+            f"Это может занять {len(queries) / MAX_REQUESTS_PER_SECOND / 60:.1f} минут"
+        )
+        queued = processing_gate.locked()
+        status_message = await message.answer(
+            "⏳ Сервер занят, ваша очередь..." if queued else status_text
         )
 
-        # Обрабатываем запросы
-        csv_data = await process_queries(queries, status_message)
+        # Обрабатываем запросы (не более MAX_ACTIVE_PROCESSING списков одновременно)
+        async with processing_gate:
+            if queued:
+                await status_message.edit_text(status_text)
+            result = await process_queries(queries, status_message, xmlriver, parse_pool)
         
-        if csv_data is None:
+        if result is None:
             return
 
+        if result.interrupted:
+            caption = f"⚠️ Обработка прервана. Частичный результат: {result.written} из {len(queries)} запросов"
+        else:
+            caption = f"✅ Готово! Обработано {result.written} из {len(queries)} запросов"
+        if result.failed:
+            caption += f"\n❌ Ошибок: {result.failed}"
+
         # Отправляем результат
         try:
             await status_message.edit_text("📤 Отправляю результат...")
             
-            input_file = BufferedInputFile(
-                csv_data,
+            input_file = FSInputFile(
+                result.path,
                 filename=f"search_results_{len(queries)}_queries.csv"
             )
             
             await message.answer_document(
                 document=input_file,
-                caption=f"✅ Готово! Обработано {len(queries)} запросов"
+                caption=caption
             )
             
             # Удаляем статусное сообщение
@@ -252,6 +618,8 @@ async def handle_message(message: Message):
         except Exception as e:
             logger.error(f"Ошибка при отправке документа: {e}")
             await message.reply("❌ Ошибка при отправке результата")
+        finally:
+            os.remove(result.path)
 
     except Exception as e:
         logger.error(f"Общая ошибка в handle_message: {e}")
@@ -268,24 +636,43 @@ async def handle_other(message: Message):
 async def main():
     """Главная функция"""
     logger.info("Запуск бота...")
+
+    # Бот, клиент xmlriver и пул процессов для разбора XML создаются один раз и передаются
+    # обработчикам через данные диспетчера. Создаем их здесь, а не при импорте модуля:
+    # процессы пула заново импортируют этот модуль
+    bot = Bot(token=BOT_TOKEN)
+    xmlriver = XmlRiverClient()
+    dp['xmlriver'] = xmlriver
+    parse_pool = ParsePool(max_workers=os.cpu_count())
+    dp['parse_pool'] = parse_pool
+    # Ограничение одновременной обработки, чтобы несколько больших списков не исчерпали память
+    dp['processing_gate'] = asyncio.Semaphore(MAX_ACTIVE_PROCESSING)
     
     try:
         # Удаляем webhook если был установлен
         await bot.delete_webhook(drop_pending_updates=True)
         
-        # Запускаем polling
+        # Запускаем polling (старые обновления уже сброшены через drop_pending_updates)
         await dp.start_polling(
             bot,
-            skip_updates=True,  # Пропускаем старые обновления
-            allowed_updates=["message"]  # Обрабатываем только сообщения
+            allowed_updates=dp.resolve_used_update_types()  # Только типы обновлений, для которых есть обработчики
         )
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
     finally:
+        parse_pool.shutdown()
+        xmlriver.close()
         await bot.session.close()
         logger.info("Бот остановлен")
 
 if __name__ == '__main__':
+    # uvloop ускоряет цикл событий, если установлен (недоступен на Windows)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt: